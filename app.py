@@ -3,26 +3,183 @@ import uuid
 import zipfile
 import shutil
 import asyncio
-import json
+import logging
+import time
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 from datetime import datetime, timedelta
 from typing import Optional
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse
 
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks, Request, Header, Depends
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks, Request, Header, Depends, Query
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, Response
 from fastapi.security import APIKeyHeader
 import redis.asyncio as redis
 import aiofiles
 import httpx
+import orjson
+from python_multipart.multipart import MultipartParser, parse_options_header
 
 from config import config
 
-app = FastAPI(title="Video Processing Service")
+app = FastAPI(title="Video Processing Service", default_response_class=ORJSONResponse)
+
+logger = logging.getLogger("video_convertor")
+
+# Общая очередь логов процесса: в неё пишут и наши логгеры, и логгеры uvicorn
+log_queue = SimpleQueue()
+
+# Поток QueueListener, пишущий логи в stderr вне event loop
+log_listener = None
+
+class QueueLogHandler(QueueHandler):
+    """QueueHandler, привязанный к общей очереди логов модуля — на него
+    ссылается UVICORN_LOG_CONFIG по пути класса"""
+
+    def __init__(self):
+        super().__init__(log_queue)
+
+# Конфиг логирования uvicorn: его логгеры (включая uvicorn.access, который
+# не пропагирует в root и по умолчанию пишет в stderr синхронно) тоже
+# отправляют записи в очередь, а не блокируют event loop записью
+UVICORN_LOG_CONFIG = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "queue": {"class": "app.QueueLogHandler"},
+    },
+    "loggers": {
+        "uvicorn": {"handlers": ["queue"], "level": "INFO", "propagate": False},
+        "uvicorn.error": {"handlers": ["queue"], "level": "INFO", "propagate": False},
+        "uvicorn.access": {"handlers": ["queue"], "level": "INFO", "propagate": False},
+    },
+}
+
+def setup_logging():
+    """Настраивает неблокирующее логирование: записи уходят в очередь,
+    а в stderr их пишет QueueListener в отдельном потоке"""
+    global log_listener
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(log_queue))
+    log_listener = QueueListener(log_queue, handler)
+    log_listener.start()
+
+class CircuitBreaker:
+    """Простой circuit breaker: после N ошибок подряд переходит в open и
+    сразу отклоняет вызовы; по истечении recovery_seconds пропускает один
+    пробный вызов (half_open) и по его результату закрывается или
+    открывается снова"""
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_seconds: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.failures = 0
+        self.opened_at = 0.0
+        self.state = "closed"
+
+    def allow(self) -> bool:
+        """Можно ли выполнять вызов сейчас"""
+        if self.state == "open":
+            if time.monotonic() - self.opened_at >= self.recovery_seconds:
+                self.state = "half_open"
+                return True
+            return False
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.state = "closed"
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+redis_breaker = CircuitBreaker("redis")
+webhook_breaker = CircuitBreaker("webhook")
+
+class RedisUnavailableError(Exception):
+    """Redis недоступен: circuit breaker открыт"""
+
+async def guarded_redis_call(make_call):
+    """Вызов Redis с таймаутом и circuit breaker: зависший Redis не копит
+    висящие запросы, а при открытом breaker отказ мгновенный.
+    make_call — функция без аргументов, возвращающая awaitable: корутина
+    создаётся только если breaker пропустил вызов"""
+    if not redis_breaker.allow():
+        raise RedisUnavailableError("circuit breaker открыт")
+
+    try:
+        async with asyncio.timeout(config.REDIS_TIMEOUT_SECONDS):
+            result = await make_call()
+    except Exception:
+        redis_breaker.record_failure()
+        raise
+
+    redis_breaker.record_success()
+    return result
+
+@app.exception_handler(RedisUnavailableError)
+async def redis_unavailable_handler(request: Request, exc: RedisUnavailableError):
+    """Открытый breaker превращается в 503 только на HTTP-слое;
+    фоновые задачи получают RedisUnavailableError и решают сами"""
+    return ORJSONResponse(status_code=503, content={"detail": "Redis недоступен"})
 
 # Redis connection
 redis_client = None
 
+# Отдельный Redis клиент для /health (свой пул, не блокирует основной)
+redis_health_client = None
+
+# HTTP клиент для webhook уведомлений (переиспользует соединения)
+http_client = None
+
+# Фоновая задача, слушающая уведомления об истёкших ключах
+delete_listener_task = None
+
+# Кэш главной страницы: читаем index.html один раз при старте
+index_html = b""
+index_html_status = 200
+
+# Абсолютный путь к скрипту обработки, проверяется один раз при старте
+script_path = None
+
+# Bulkhead: ограничивает число одновременно работающих обработок видео
+encode_semaphore = None
+
+# Размер блока при отдаче результата через FileResponse (1 МиБ вместо 64 КиБ)
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Максимальное число попыток отправки webhook уведомления
+WEBHOOK_MAX_ATTEMPTS = 3
+
+# TTL записи о задаче: время хранения файла + 1 час на обработку
+TASK_TTL_SECONDS = (config.FILE_RETENTION_HOURS + 1) * 3600
+
+# Сколько последних строк stderr скрипта сохранять для сообщения об ошибке
+STDERR_TAIL_LINES = 100
+
+# Буфер StreamReader для вывода скрипта: дефолтные 64 КиБ валят чтение
+# ValueError на первой же сверхдлинной строке
+SUBPROCESS_STREAM_LIMIT = 1 << 20
+
+# Префикс ключей-таймеров удаления готовых файлов
+DELETE_KEY_PREFIX = f"{config.REDIS_KEY_PREFIX}delete:"
+
+# Пауза перед восстановлением подписки на истёкшие ключи после обрыва
+DELETE_LISTENER_RETRY_SECONDS = 5
+
+# Префикс ключей статусов в байтах: основной клиент работает в байтовом
+# режиме, так что конкатенация готовых bytes дешевле f-string + encode
+STATUS_KEY_PREFIX = config.REDIS_KEY_PREFIX.encode()
+
 # API Key Security
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
 
@@ -48,84 +205,175 @@ async def verify_api_key(api_key: str = Depends(api_key_header)):
 
 @app.on_event("startup")
 async def startup_event():
-    global redis_client
-    redis_client = await redis.from_url(
+    global redis_client, redis_health_client, http_client, delete_listener_task
+    global index_html, index_html_status, script_path, encode_semaphore
+
+    setup_logging()
+
+    # Явный пул соединений: параллельные запросы не ждут один сокет
+    pool = redis.ConnectionPool.from_url(
         config.REDIS_URL,
         password=config.REDIS_PASSWORD if config.REDIS_PASSWORD else None,
         db=config.REDIS_DB,
+        max_connections=config.REDIS_MAX_CONNECTIONS,
+        encoding="utf-8",
+        # orjson работает с bytes напрямую, декодирование ответов не нужно
+        decode_responses=False
+    )
+    redis_client = redis.Redis(connection_pool=pool)
+
+    health_pool = redis.ConnectionPool.from_url(
+        config.REDIS_URL,
+        password=config.REDIS_PASSWORD if config.REDIS_PASSWORD else None,
+        db=config.REDIS_DB,
+        max_connections=config.REDIS_HEALTH_MAX_CONNECTIONS,
         encoding="utf-8",
         decode_responses=True
     )
-    
+    redis_health_client = redis.Redis(connection_pool=health_pool)
+
+    # Один долгоживущий HTTP клиент вместо нового на каждый webhook
+    http_client = httpx.AsyncClient(
+        timeout=10.0,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)
+    )
+
+    # Уведомления об истёкших ключах нужны для удаления готовых файлов по TTL
+    try:
+        await redis_client.config_set("notify-keyspace-events", "Ex")
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось включить notify-keyspace-events (включите Ex вручную): {e}")
+
+    delete_listener_task = asyncio.create_task(expired_key_listener())
+
+    # Лимит задаётся на воркер-процесс: воркеров запускается по числу CPU,
+    # поэтому один слот на воркер даёт ~cpu_count обработок на всю машину
+    encode_semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_ENCODES or 1)
+
+    # Скрипт обработки проверяем один раз при старте: лучше упасть сразу,
+    # чем проверять путь и права на каждую задачу
+    script_path = os.path.abspath(config.SCRIPT_PATH)
+    if not os.path.exists(script_path):
+        raise RuntimeError(f"Скрипт не найден: {script_path}")
+    if not os.access(script_path, os.X_OK):
+        raise RuntimeError(f"Скрипт не имеет прав на выполнение: {script_path}")
+
+    # Читаем главную страницу один раз, а не на каждый запрос
+    try:
+        with open("index.html", "rb") as f:
+            index_html = f.read()
+    except FileNotFoundError:
+        index_html = b"<h1>index.html not found</h1>"
+        index_html_status = 404
+
     # Создаём необходимые директории
     os.makedirs(config.TEMP_DIR, exist_ok=True)
     os.makedirs(config.OUTPUT_DIR, exist_ok=True)
     
-    print(f"✅ Сервис запущен")
-    print(f"📁 Временная папка: {config.TEMP_DIR}")
-    print(f"📁 Папка результатов: {config.OUTPUT_DIR}")
-    print(f"🔑 API ключ: {'настроен' if config.API_KEY else 'не настроен (доступ открыт)'}")
-    print(f"🔔 Webhook: {'настроен' if config.WEBHOOK_URL else 'не настроен'}")
+    logger.info(f"✅ Сервис запущен")
+    logger.info(f"📁 Временная папка: {config.TEMP_DIR}")
+    logger.info(f"📁 Папка результатов: {config.OUTPUT_DIR}")
+    logger.info(f"🔑 API ключ: {'настроен' if config.API_KEY else 'не настроен (доступ открыт)'}")
+    logger.info(f"🔔 Webhook: {'настроен' if config.WEBHOOK_URL else 'не настроен'}")
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    if delete_listener_task:
+        delete_listener_task.cancel()
     if redis_client:
         await redis_client.close()
+    if redis_health_client:
+        await redis_health_client.close()
+    if http_client:
+        await http_client.aclose()
+    if log_listener:
+        log_listener.stop()
+
+async def drain_stream(stream: asyncio.StreamReader, prefix: str, tail: Optional[deque] = None):
+    """Читает поток subprocess построчно, логируя строки по мере поступления"""
+    async for line in stream:
+        text = line.decode(errors='replace')
+        if tail is not None:
+            tail.append(text)
+        logger.info(f"{prefix} {text.rstrip()}")
+
+def extract_zip(zip_path: str, work_dir: str):
+    """Распаковывает ZIP архив (синхронно, вызывается через asyncio.to_thread)"""
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        zip_ref.extractall(work_dir)
 
-def get_redis_key(task_id: str) -> str:
+def get_redis_key(task_id: str) -> bytes:
     """Генерирует ключ Redis с префиксом"""
-    return f"{config.REDIS_KEY_PREFIX}{task_id}"
+    return STATUS_KEY_PREFIX + task_id.encode()
 
-async def save_task_status(task_id: str, status: str, **kwargs):
-    """Сохраняет статус задачи в Redis"""
+async def save_task_status(task_id: str, status: str, **kwargs) -> dict:
+    """Сохраняет статус задачи в Redis и возвращает сохранённые данные"""
     task_data = {
         "task_id": task_id,
         "status": status,
-        "created_at": datetime.now().isoformat(),
         **kwargs
     }
-    
+    # Не перезаписываем created_at, если вызывающий передал свой
+    task_data.setdefault("created_at", datetime.now().isoformat())
+
+    # SET c EX — один round trip вместо SET + EXPIRE
     key = get_redis_key(task_id)
-    await redis_client.set(key, json.dumps(task_data))
-    
-    # Устанавливаем TTL (время жизни + 1 час на обработку)
-    ttl_seconds = (config.FILE_RETENTION_HOURS + 1) * 3600
-    await redis_client.expire(key, ttl_seconds)
+    await guarded_redis_call(lambda: redis_client.set(key, orjson.dumps(task_data), ex=TASK_TTL_SECONDS))
+    return task_data
 
 async def get_task_status(task_id: str) -> Optional[dict]:
     """Получает статус задачи из Redis"""
     key = get_redis_key(task_id)
-    data = await redis_client.get(key)
+    data = await guarded_redis_call(lambda: redis_client.get(key))
     
     if data:
-        return json.loads(data)
+        return orjson.loads(data)
     return None
 
 async def send_webhook_notification(task_data: dict):
     """Отправляет уведомление на webhook"""
     if not config.WEBHOOK_URL:
-        print("⚠️ Webhook URL не настроен, уведомление не отправлено")
+        logger.warning("⚠️ Webhook URL не настроен, уведомление не отправлено")
         return
-    
+
+    if not webhook_breaker.allow():
+        logger.warning("⚠️ Webhook breaker открыт, уведомление пропущено")
+        return
+
     try:
-        print(f"🔔 Отправка webhook уведомления на {config.WEBHOOK_URL}")
-        
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(
+        logger.info(f"🔔 Отправка webhook уведомления на {config.WEBHOOK_URL}")
+
+        # Повторяем только временные ошибки (5xx/429), 4xx не повторяем
+        for attempt in range(1, WEBHOOK_MAX_ATTEMPTS + 1):
+            response = await http_client.post(
                 config.WEBHOOK_URL,
                 json=task_data,
                 headers={"Content-Type": "application/json"}
             )
-            
+
             if response.status_code == 200:
-                print(f"✅ Webhook уведомление отправлено успешно")
-            else:
-                print(f"⚠️ Webhook вернул статус {response.status_code}: {response.text}")
-    
+                logger.info(f"✅ Webhook уведомление отправлено успешно")
+                webhook_breaker.record_success()
+                return
+
+            if response.status_code >= 500 or response.status_code == 429:
+                logger.warning(f"⚠️ Webhook вернул статус {response.status_code}, попытка {attempt}/{WEBHOOK_MAX_ATTEMPTS}")
+                if attempt < WEBHOOK_MAX_ATTEMPTS:
+                    await asyncio.sleep(2 ** (attempt - 1))
+                continue
+
+            logger.warning(f"⚠️ Webhook вернул статус {response.status_code}: {response.text}")
+            return
+
+        # Все попытки исчерпаны (5xx/429)
+        webhook_breaker.record_failure()
+
     except httpx.TimeoutException:
-        print(f"⚠️ Timeout при отправке webhook уведомления")
+        webhook_breaker.record_failure()
+        logger.warning(f"⚠️ Timeout при отправке webhook уведомления")
     except Exception as e:
-        print(f"⚠️ Ошибка при отправке webhook уведомления: {e}")
+        webhook_breaker.record_failure()
+        logger.warning(f"⚠️ Ошибка при отправке webhook уведомления: {e}")
 
 async def process_video_task(
     task_id: str,
@@ -135,241 +383,382 @@ async def process_video_task(
     work_dir: str
 ):
     """Фоновая задача обработки видео"""
-    try:
-        print(f"🎬 Начало обработки задачи {task_id}")
-        print(f"   ZIP: {zip_path}")
-        print(f"   Музыка: {music_path}")
-        print(f"   Рабочая папка: {work_dir}")
-        
-        await save_task_status(task_id, "processing", message="Распаковка архива...")
-        
-        # Проверяем существование ZIP файла
-        if not os.path.exists(zip_path):
-            await save_task_status(
-                task_id, 
-                "failed", 
-                error=f"ZIP файл не найден: {zip_path}"
-            )
-            return
-        
-        print(f"✓ ZIP файл найден: {zip_path}")
-        
-        # Распаковываем ZIP архив
+    # Лишние задачи ждут свободный слот здесь, оставаясь в статусе pending
+    async with encode_semaphore:
         try:
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(work_dir)
-            print(f"✓ Архив распакован в: {work_dir}")
-        except Exception as e:
-            await save_task_status(
-                task_id, 
-                "failed", 
-                error=f"Ошибка распаковки архива: {str(e)}"
-            )
-            return
-        
-        # Подсчитываем количество .mp4 файлов
-        all_files = os.listdir(work_dir)
-        print(f"📁 Файлы в рабочей папке: {all_files}")
-        
-        mp4_files = sorted([f for f in all_files if f.endswith('.mp4')])
-        num_files = len(mp4_files)
-        
-        print(f"🎥 Найдено MP4 файлов: {num_files}")
-        print(f"   Список: {mp4_files}")
-        
-        if num_files == 0:
-            await save_task_status(
-                task_id, 
-                "failed", 
-                error="В архиве не найдено .mp4 файлов"
-            )
-            return
-        
-        # Проверяем существование музыкального файла
-        if not os.path.exists(music_path):
-            await save_task_status(
-                task_id, 
-                "failed", 
-                error=f"Музыкальный файл не найден: {music_path}"
-            )
-            return
+            logger.info(f"🎬 Начало обработки задачи {task_id}")
+            logger.info(f"   ZIP: {zip_path}")
+            logger.info(f"   Музыка: {music_path}")
+            logger.info(f"   Рабочая папка: {work_dir}")
         
-        print(f"✓ Музыкальный файл найден: {music_path}")
+            await save_task_status(task_id, "processing", message="Распаковка архива...")
         
-        await save_task_status(
-            task_id, 
-            "processing", 
-            message=f"Обработка {num_files} видео файлов..."
-        )
+            # Проверяем существование ZIP файла
+            if not os.path.exists(zip_path):
+                await save_task_status(
+                    task_id, 
+                    "failed", 
+                    error=f"ZIP файл не найден: {zip_path}"
+                )
+                return
         
-        # Проверяем существование скрипта
-        script_path = os.path.abspath(config.SCRIPT_PATH)
-        if not os.path.exists(script_path):
-            await save_task_status(
-                task_id, 
-                "failed", 
-                error=f"Скрипт не найден: {script_path}"
-            )
-            return
+            logger.info(f"✓ ZIP файл найден: {zip_path}")
         
-        print(f"✓ Скрипт найден: {script_path}")
+            # Распаковываем ZIP архив в отдельном потоке, чтобы не блокировать event loop
+            try:
+                await asyncio.to_thread(extract_zip, zip_path, work_dir)
+                logger.info(f"✓ Архив распакован в: {work_dir}")
+            except Exception as e:
+                await save_task_status(
+                    task_id, 
+                    "failed", 
+                    error=f"Ошибка распаковки архива: {str(e)}"
+                )
+                return
+        
+            # Подсчитываем количество .mp4 файлов (scandir — один проход по каталогу)
+            with os.scandir(work_dir) as entries:
+                mp4_files = sorted(e.name for e in entries if e.name.endswith('.mp4'))
+            num_files = len(mp4_files)
+
+            logger.info(f"🎥 Найдено MP4 файлов: {num_files}")
+        
+            if num_files == 0:
+                await save_task_status(
+                    task_id, 
+                    "failed", 
+                    error="В архиве не найдено .mp4 файлов"
+                )
+                return
+        
+            # Проверяем существование музыкального файла
+            if not os.path.exists(music_path):
+                await save_task_status(
+                    task_id, 
+                    "failed", 
+                    error=f"Музыкальный файл не найден: {music_path}"
+                )
+                return
+        
+            logger.info(f"✓ Музыкальный файл найден: {music_path}")
         
-        # Проверяем права на выполнение
-        if not os.access(script_path, os.X_OK):
             await save_task_status(
                 task_id, 
-                "failed", 
-                error=f"Скрипт не имеет прав на выполнение: {script_path}"
+                "processing", 
+                message=f"Обработка {num_files} видео файлов..."
             )
-            return
         
-        print(f"✓ Скрипт имеет права на выполнение")
+            # Запускаем скрипт обработки (путь и права проверены при старте)
+            result_path = os.path.join(work_dir, "result.mp4")
         
-        # Запускаем скрипт обработки
-        result_path = os.path.join(work_dir, "result.mp4")
-        
-        # Используем абсолютный путь к музыке
-        abs_music_path = os.path.abspath(music_path)
-        
-        print(f"🚀 Запуск скрипта:")
-        print(f"   Команда: {script_path} {num_files} {abs_music_path} {fade_duration}")
-        print(f"   CWD: {work_dir}")
-        
-        process = await asyncio.create_subprocess_exec(
-            script_path,
-            str(num_files),
-            abs_music_path,
-            str(fade_duration),
-            cwd=work_dir,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout, stderr = await process.communicate()
-        
-        # Логируем вывод скрипта
-        if stdout:
-            stdout_text = stdout.decode()
-            print(f"📝 STDOUT задачи {task_id}:")
-            print(stdout_text)
-        
-        if stderr:
-            stderr_text = stderr.decode()
-            print(f"⚠️ STDERR задачи {task_id}:")
-            print(stderr_text)
-        
-        print(f"🔚 Скрипт завершился с кодом: {process.returncode}")
-        
-        if process.returncode != 0:
-            error_msg = stderr.decode() if stderr else "Неизвестная ошибка"
-            await save_task_status(
-                task_id, 
-                "failed", 
-                error=f"Ошибка обработки (код {process.returncode}): {error_msg}"
+            # Используем абсолютный путь к музыке
+            abs_music_path = os.path.abspath(music_path)
+
+            # Аргументы скрипта приводим к строкам один раз
+            num_files_arg = str(num_files)
+            fade_arg = str(fade_duration)
+
+            logger.info(f"🚀 Запуск скрипта:")
+            logger.info(f"   Команда: {script_path} {num_files_arg} {abs_music_path} {fade_arg}")
+            logger.info(f"   CWD: {work_dir}")
+
+            process = await asyncio.create_subprocess_exec(
+                script_path,
+                num_files_arg,
+                abs_music_path,
+                fade_arg,
+                cwd=work_dir,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                limit=SUBPROCESS_STREAM_LIMIT
             )
-            return
-        
-        # Проверяем, что результат создан
-        print(f"🔍 Проверка результата: {result_path}")
-        
-        if not os.path.exists(result_path):
-            files_in_workdir = os.listdir(work_dir)
-            await save_task_status(
-                task_id, 
-                "failed", 
-                error=f"Результирующий файл не создан. Файлы в папке: {files_in_workdir}"
+
+            # Читаем stdout/stderr по мере работы скрипта: не копим весь вывод в памяти
+            # и не упираемся в переполнение pipe буфера
+            stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+            try:
+                await asyncio.gather(
+                    drain_stream(process.stdout, f"📝 [{task_id}]"),
+                    drain_stream(process.stderr, f"⚠️ [{task_id}]", tail=stderr_tail),
+                    process.wait()
+                )
+            except Exception:
+                # Если чтение вывода сломалось, скрипт нельзя оставлять работать:
+                # finally ниже удалит рабочую папку у него из-под ног
+                if process.returncode is None:
+                    try:
+                        process.terminate()
+                    except ProcessLookupError:
+                        pass
+                    await process.wait()
+                raise
+
+            logger.info(f"🔚 Скрипт завершился с кодом: {process.returncode}")
+
+            if process.returncode != 0:
+                error_msg = "".join(stderr_tail) if stderr_tail else "Неизвестная ошибка"
+                await save_task_status(
+                    task_id, 
+                    "failed", 
+                    error=f"Ошибка обработки (код {process.returncode}): {error_msg}"
+                )
+                return
+        
+            # Проверяем, что результат создан
+            logger.info(f"🔍 Проверка результата: {result_path}")
+        
+            if not os.path.exists(result_path):
+                with os.scandir(work_dir) as entries:
+                    files_in_workdir = [e.name for e in entries]
+                await save_task_status(
+                    task_id, 
+                    "failed", 
+                    error=f"Результирующий файл не создан. Файлы в папке: {files_in_workdir}"
+                )
+                return
+        
+            logger.info(f"✓ Результат создан: {result_path}")
+        
+            # Перемещаем результат в папку output
+            output_path = os.path.join(config.OUTPUT_DIR, f"{task_id}.mp4")
+            await asyncio.to_thread(shutil.move, result_path, output_path)
+        
+            logger.info(f"✓ Файл перемещён в: {output_path}")
+        
+            # Получаем размер файла
+            file_size = os.path.getsize(output_path)
+        
+            logger.info(f"✓ Размер файла: {file_size} байт")
+        
+            # Время берём один раз: от него считаем и завершение, и удаление файла
+            now = datetime.now()
+            expires_at = now + timedelta(hours=config.FILE_RETENTION_HOURS)
+
+            # Сохраняем финальный статус
+            task_data = await save_task_status(
+                task_id,
+                "success",
+                message="Обработка завершена",
+                output_file=f"{task_id}.mp4",
+                file_size=file_size,
+                expires_at=expires_at.isoformat(),
+                completed_at=now.isoformat(),
+                created_at=now.isoformat()
             )
-            return
-        
-        print(f"✓ Результат создан: {result_path}")
-        
-        # Перемещаем результат в папку output
-        output_path = os.path.join(config.OUTPUT_DIR, f"{task_id}.mp4")
-        shutil.move(result_path, output_path)
-        
-        print(f"✓ Файл перемещён в: {output_path}")
-        
-        # Получаем размер файла
-        file_size = os.path.getsize(output_path)
         
-        print(f"✓ Размер файла: {file_size} байт")
+            logger.info(f"✅ Задача {task_id} завершена успешно")
         
-        # Устанавливаем время удаления файла
-        expires_at = datetime.now() + timedelta(hours=config.FILE_RETENTION_HOURS)
+            # Отправляем webhook уведомление
+            await send_webhook_notification(task_data)
         
-        # Сохраняем финальный статус
-        task_data = {
-            "task_id": task_id,
-            "status": "success",
-            "message": "Обработка завершена",
-            "output_file": f"{task_id}.mp4",
-            "file_size": file_size,
-            "expires_at": expires_at.isoformat(),
-            "completed_at": datetime.now().isoformat()
-        }
+            # Планируем удаление результата через N часов (через TTL ключа в Redis)
+            await schedule_file_deletion(task_id)
         
-        await save_task_status(
-            task_id,
-            "success",
-            message="Обработка завершена",
-            output_file=f"{task_id}.mp4",
-            file_size=file_size,
-            expires_at=expires_at.isoformat(),
-            completed_at=datetime.now().isoformat()
-        )
-        
-        print(f"✅ Задача {task_id} завершена успешно")
-        
-        # Отправляем webhook уведомление
-        await send_webhook_notification(task_data)
-        
-        # Планируем удаление результата через N часов (в фоне)
-        asyncio.create_task(delete_file_after_delay(output_path, task_id, config.FILE_RETENTION_HOURS))
-        
-    except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"❌ Ошибка в задаче {task_id}:")
-        print(error_details)
-        
-        await save_task_status(
-            task_id,
-            "failed",
-            error=str(e),
-            details=error_details
-        )
-    finally:
-        # Очищаем временную папку ПОСЛЕ завершения обработки
-        print(f"🧹 Очистка временных файлов для задачи {task_id}")
-        
-        # Удаляем рабочую директорию
-        if os.path.exists(work_dir):
-            try:
-                shutil.rmtree(work_dir)
-                print(f"✓ Удалена рабочая папка: {work_dir}")
-            except Exception as e:
-                print(f"⚠️ Не удалось удалить рабочую папку {work_dir}: {e}")
-        
-        # Удаляем ZIP архив
-        if os.path.exists(zip_path):
+        except Exception as e:
+            import traceback
+            error_details = traceback.format_exc()
+            logger.error(f"❌ Ошибка в задаче {task_id}:")
+            logger.error(error_details)
+
+            # Запись статуса — best effort: если Redis недоступен,
+            # задача не должна умереть с необработанным исключением
             try:
-                os.remove(zip_path)
-                print(f"✓ Удалён ZIP архив: {zip_path}")
-            except Exception as e:
-                print(f"⚠️ Не удалось удалить ZIP архив {zip_path}: {e}")
-        
-        print(f"✅ Временные файлы для задачи {task_id} очищены")
+                await save_task_status(
+                    task_id,
+                    "failed",
+                    error=str(e),
+                    details=error_details
+                )
+            except Exception as save_error:
+                logger.warning(f"⚠️ Не удалось сохранить статус failed для {task_id}: {save_error}")
+        finally:
+            # Очищаем временную папку ПОСЛЕ завершения обработки
+            logger.info(f"🧹 Очистка временных файлов для задачи {task_id}")
+        
+            # Удаляем рабочую директорию (в отдельном потоке, чтобы не блокировать loop)
+            if os.path.exists(work_dir):
+                try:
+                    await asyncio.to_thread(shutil.rmtree, work_dir)
+                    logger.info(f"✓ Удалена рабочая папка: {work_dir}")
+                except Exception as e:
+                    logger.warning(f"⚠️ Не удалось удалить рабочую папку {work_dir}: {e}")
 
+            # Удаляем ZIP архив
+            if os.path.exists(zip_path):
+                try:
+                    await asyncio.to_thread(os.remove, zip_path)
+                    logger.info(f"✓ Удалён ZIP архив: {zip_path}")
+                except Exception as e:
+                    logger.warning(f"⚠️ Не удалось удалить ZIP архив {zip_path}: {e}")
+        
+            logger.info(f"✅ Временные файлы для задачи {task_id} очищены")
 
-async def delete_file_after_delay(file_path: str, task_id: str, hours: int):
-    """Удаляет файл через указанное количество часов"""
-    try:
-        await asyncio.sleep(hours * 3600)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            print(f"🗑️ Удалён файл {task_id}.mp4 (истёк срок хранения)")
-    except Exception as e:
-        print(f"⚠️ Ошибка при удалении файла {file_path}: {e}")
+
+class MultipartFileSaver:
+    """Колбэки потокового multipart парсера: файловые части накапливаются в
+    буфер и пишутся на диск через aiofiles при flush(), обычные поля формы
+    собираются в словарь. Файловые поля, которых нет в file_targets,
+    пропускаются без буферизации — как это делал request.form()"""
+
+    def __init__(self, file_targets: dict, validate_filename=None):
+        # имя файлового поля -> путь, куда писать содержимое
+        self.file_targets = file_targets
+        # validate_filename(имя поля, имя файла) вызывается по заголовкам части,
+        # до приёма её содержимого — плохая загрузка отбрасывается сразу
+        self.validate_filename = validate_filename
+        self.filenames = {}
+        self.file_sizes = {}
+        self.fields = {}
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._field_name = None
+        self._is_file = False
+        self._value = b""
+        # Куски файловых частей, ожидающие асинхронной записи: (имя поля, bytes)
+        self._pending = []
+        # имя поля -> открытый aiofiles handle
+        self._files = {}
+
+    def on_part_begin(self):
+        self._headers = {}
+        self._field_name = None
+        self._is_file = False
+        self._value = b""
+
+    def on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._field_name = options.get(b"name", b"").decode()
+        filename = options.get(b"filename")
+        self._is_file = filename is not None
+
+        if self._is_file:
+            if self._field_name in self.file_targets:
+                name = filename.decode()
+                if self.validate_filename:
+                    self.validate_filename(self._field_name, name)
+                self.filenames[self._field_name] = name
+                self.file_sizes[self._field_name] = 0
+            else:
+                # Неожиданное файловое поле: содержимое просто отбрасываем
+                self._field_name = None
+
+    def on_part_data(self, data, start, end):
+        if self._is_file:
+            if self._field_name:
+                self._pending.append((self._field_name, data[start:end]))
+                self.file_sizes[self._field_name] += end - start
+        else:
+            self._value += data[start:end]
+
+    def on_part_end(self):
+        if not self._is_file and self._field_name:
+            self.fields[self._field_name] = self._value.decode()
+
+    async def flush(self):
+        """Асинхронно дописывает накопленные куски файлов через aiofiles;
+        вызывается после каждой порции parser.write(), так что в памяти
+        одновременно не больше одного сетевого чанка"""
+        for field_name, chunk in self._pending:
+            f = self._files.get(field_name)
+            if f is None:
+                f = await aiofiles.open(self.file_targets[field_name], 'wb')
+                self._files[field_name] = f
+            await f.write(chunk)
+        self._pending.clear()
+
+    async def aclose(self):
+        for f in self._files.values():
+            await f.close()
+        self._files.clear()
+        self._pending.clear()
+
+    def parser(self, boundary) -> MultipartParser:
+        """Создаёт MultipartParser, привязанный к колбэкам этого объекта"""
+        return MultipartParser(boundary, callbacks={
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        })
+
+
+async def cleanup_failed_upload(work_dir: str, zip_path: str):
+    """Удаляет частично принятые файлы неудавшейся загрузки"""
+    if os.path.exists(work_dir):
+        await asyncio.to_thread(shutil.rmtree, work_dir, ignore_errors=True)
+    if os.path.exists(zip_path):
+        try:
+            await asyncio.to_thread(os.remove, zip_path)
+        except OSError:
+            pass
+
+
+async def schedule_file_deletion(task_id: str):
+    """Ставит таймер удаления файла через TTL ключа в Redis (переживает рестарт)"""
+    await guarded_redis_call(lambda: redis_client.set(
+        DELETE_KEY_PREFIX + task_id,
+        "1",
+        ex=config.FILE_RETENTION_HOURS * 3600
+    ))
+
+async def expired_key_listener():
+    """Единственная фоновая корутина: удаляет файлы по истечении их ключей
+    в Redis. Подписка живёт в цикле с переподключением: обрыв pubsub
+    соединения (рестарт Redis, сеть) не должен останавливать удаление"""
+    channel = f"__keyevent@{config.REDIS_DB}__:expired"
+
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.psubscribe(channel)
+
+            async for message in pubsub.listen():
+                if message["type"] != "pmessage":
+                    continue
+
+                key = message["data"]
+                if isinstance(key, bytes):
+                    key = key.decode()
+
+                if not key.startswith(DELETE_KEY_PREFIX):
+                    continue
+
+                # Значение ключа к моменту истечения уже удалено,
+                # поэтому путь к файлу восстанавливаем из task_id в имени ключа
+                task_id = key[len(DELETE_KEY_PREFIX):]
+                file_path = os.path.join(config.OUTPUT_DIR, f"{task_id}.mp4")
+
+                try:
+                    if os.path.exists(file_path):
+                        await asyncio.to_thread(os.remove, file_path)
+                        logger.info(f"🗑️ Удалён файл {task_id}.mp4 (истёк срок хранения)")
+                except Exception as e:
+                    logger.warning(f"⚠️ Ошибка при удалении файла {file_path}: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"⚠️ Потеряна подписка на истёкшие ключи: {e}, переподключение через {DELETE_LISTENER_RETRY_SECONDS} с")
+            await asyncio.sleep(DELETE_LISTENER_RETRY_SECONDS)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
 
 @app.post("/process-video", dependencies=[Depends(verify_api_key)])
 async def process_video(
@@ -386,79 +775,79 @@ async def process_video(
     - audio: MP3 файл фоновой музыки
     - fade_duration: Длительность затухания (опционально, по умолчанию 3)
     """
-    
-    print(f"📥 Получен запрос на обработку видео")
-    
+
+    logger.info(f"📥 Получен запрос на обработку видео")
+
+    # Генерируем уникальный ID задачи (hex — короче и без дефисов в путях)
+    task_id = uuid.uuid4().hex
+    work_dir = os.path.join(config.TEMP_DIR, task_id)
+    zip_path = os.path.join(config.TEMP_DIR, f"{task_id}.zip")
+    music_path = os.path.join(work_dir, "music.mp3")
+
+    def validate_filename(field_name: str, filename: str):
+        """Проверяет расширение по заголовкам части, до приёма содержимого"""
+        if field_name == "video" and not filename.endswith('.zip'):
+            raise HTTPException(status_code=400, detail="Файл video должен быть ZIP архивом")
+        if field_name == "audio" and not filename.endswith('.mp3'):
+            raise HTTPException(status_code=400, detail="Файл audio должен быть в формате MP3")
+
     try:
-        # Получаем form data
-        form = await request.form()
-        
-        print(f"📋 Полученные поля формы: {list(form.keys())}")
-        
-        # Получаем файлы
-        video_archive = form.get("video")
-        background_music = form.get("audio")
-        fade_duration = form.get("fade_duration", "3")
-        
-        print(f"   video: {video_archive.filename if video_archive else 'None'}")
-        print(f"   audio: {background_music.filename if background_music else 'None'}")
-        print(f"   fade_duration: {fade_duration}")
-        
+        content_type, ct_options = parse_options_header(
+            request.headers.get("content-type", "")
+        )
+        boundary = ct_options.get(b"boundary")
+
+        if content_type != b"multipart/form-data" or not boundary:
+            raise HTTPException(status_code=400, detail="Ожидается multipart/form-data")
+
+        logger.info(f"🆔 Создана задача: {task_id}")
+
+        # Создаём рабочую директорию
+        os.makedirs(work_dir, exist_ok=True)
+
+        # Разбираем multipart прямо из потока запроса: байты файлов пишутся
+        # на диск по мере приёма, без спулинга тела во временный файл
+        # Starlette и повторного чтения UploadFile
+        saver = MultipartFileSaver(
+            {"video": zip_path, "audio": music_path},
+            validate_filename=validate_filename
+        )
+        parser = saver.parser(boundary)
+
+        try:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                await saver.flush()
+            parser.finalize()
+            await saver.flush()
+        finally:
+            await saver.aclose()
+
+        logger.info(f"📋 Полученные поля формы: {list(saver.fields) + list(saver.filenames)}")
+
         # Валидация
-        if not video_archive:
+        if "video" not in saver.filenames:
             raise HTTPException(status_code=400, detail="Не загружен файл video")
-        
-        if not background_music:
+
+        if "audio" not in saver.filenames:
             raise HTTPException(status_code=400, detail="Не загружен файл audio")
-        
-        if not video_archive.filename.endswith('.zip'):
-            raise HTTPException(status_code=400, detail="Файл video должен быть ZIP архивом")
-        
-        if not background_music.filename.endswith('.mp3'):
-            raise HTTPException(status_code=400, detail="Файл audio должен быть в формате MP3")
-        
+
+        logger.info(f"✓ ZIP сохранён: {saver.file_sizes['video']} байт")
+        logger.info(f"✓ Музыка сохранена: {saver.file_sizes['audio']} байт")
+
         # Конвертируем fade_duration
         try:
-            fade_duration = int(fade_duration)
+            fade_duration = int(saver.fields.get("fade_duration", "3"))
         except:
             fade_duration = 3
-        
+
         if fade_duration < 0 or fade_duration > 10:
             raise HTTPException(status_code=400, detail="Длительность затухания должна быть от 0 до 10 секунд")
-        
-        # Генерируем уникальный ID задачи
-        task_id = str(uuid.uuid4())
-        
-        print(f"🆔 Создана задача: {task_id}")
-        
-        # Создаём рабочую директорию
-        work_dir = os.path.join(config.TEMP_DIR, task_id)
-        os.makedirs(work_dir, exist_ok=True)
-        
-        # Сохраняем ZIP архив
-        zip_path = os.path.join(config.TEMP_DIR, f"{task_id}.zip")
-        print(f"💾 Сохранение ZIP: {zip_path}")
-        
-        async with aiofiles.open(zip_path, 'wb') as f:
-            content = await video_archive.read()
-            await f.write(content)
-        
-        print(f"✓ ZIP сохранён: {len(content)} байт")
-        
-        # Сохраняем музыку
-        music_path = os.path.join(work_dir, "music.mp3")
-        print(f"💾 Сохранение музыки: {music_path}")
-        
-        async with aiofiles.open(music_path, 'wb') as f:
-            content = await background_music.read()
-            await f.write(content)
-        
-        print(f"✓ Музыка сохранена: {len(content)} байт")
-        
+
         # Сохраняем начальный статус
         await save_task_status(task_id, "pending", message="Задача создана")
         
-        print(f"✓ Статус сохранён в Redis")
+        logger.info(f"✓ Статус сохранён в Redis")
         
         # Запускаем фоновую обработку
         background_tasks.add_task(
@@ -470,7 +859,7 @@ async def process_video(
             work_dir
         )
         
-        print(f"✓ Фоновая задача запущена")
+        logger.info(f"✓ Фоновая задача запущена")
         
         return JSONResponse(
             status_code=202,
@@ -482,13 +871,15 @@ async def process_video(
         )
         
     except HTTPException:
+        await cleanup_failed_upload(work_dir, zip_path)
         raise
     except Exception as e:
         import traceback
         error_details = traceback.format_exc()
-        print(f"❌ Ошибка при создании задачи:")
-        print(error_details)
-        
+        logger.error(f"❌ Ошибка при создании задачи:")
+        logger.error(error_details)
+
+        await cleanup_failed_upload(work_dir, zip_path)
         raise HTTPException(status_code=500, detail=f"Ошибка создания задачи: {str(e)}")
 
 @app.get("/task-status/{task_id}", dependencies=[Depends(verify_api_key)])
@@ -512,6 +903,31 @@ async def get_task_status_endpoint(task_id: str):
     
     return task_data
 
+@app.get("/task-status", dependencies=[Depends(verify_api_key)])
+async def get_task_status_batch(ids: str = Query(..., description="ID задач через запятую")):
+    """
+    Получает статусы нескольких задач за один запрос
+
+    Требуется заголовок: X-API-Key
+
+    Принимает ID через запятую: /task-status?ids=task1,task2,task3
+    Один MGET в Redis вместо N опросов /task-status/{task_id};
+    для неизвестных задач возвращается null
+    """
+
+    task_ids = [task_id.strip() for task_id in ids.split(",") if task_id.strip()]
+
+    if not task_ids:
+        raise HTTPException(status_code=400, detail="Не переданы ID задач")
+
+    keys = [get_redis_key(task_id) for task_id in task_ids]
+    values = await guarded_redis_call(lambda: redis_client.mget(keys))
+
+    return {
+        task_id: orjson.loads(data) if data else None
+        for task_id, data in zip(task_ids, values)
+    }
+
 @app.get("/download/{task_id}", dependencies=[Depends(verify_api_key)])
 async def download_result(task_id: str):
     """
@@ -537,25 +953,44 @@ async def download_result(task_id: str):
     
     if not os.path.exists(output_file):
         raise HTTPException(status_code=404, detail="Файл не найден или удалён")
-    
-    return FileResponse(
+
+    # Если настроен nginx, отдаём файл через X-Accel-Redirect (zero-copy sendfile)
+    if config.NGINX_ACCEL_PREFIX:
+        return Response(
+            headers={
+                "X-Accel-Redirect": f"{config.NGINX_ACCEL_PREFIX}/{task_id}.mp4",
+                "Content-Type": "video/mp4",
+                "Content-Disposition": f'attachment; filename="result_{task_id}.mp4"'
+            }
+        )
+
+    response = FileResponse(
         output_file,
         media_type="video/mp4",
         filename=f"result_{task_id}.mp4"
     )
+    # Крупные блоки — меньше итераций цикла чтение/запись на большом MP4
+    response.chunk_size = DOWNLOAD_CHUNK_SIZE
+    return response
 
 @app.get("/health")
 async def health_check():
     """Проверка работоспособности сервиса (без авторизации)"""
     try:
-        await redis_client.ping()
+        async with asyncio.timeout(config.REDIS_TIMEOUT_SECONDS):
+            await redis_health_client.ping()
         redis_status = "ok"
     except:
         redis_status = "error"
-    
+
     return {
         "status": "ok",
         "redis": redis_status,
+        "circuit_breakers": {
+            "redis": redis_breaker.state,
+            "webhook": webhook_breaker.state
+        },
+        "free_encode_slots": encode_semaphore._value if encode_semaphore else None,
         "script_exists": os.path.exists(config.SCRIPT_PATH),
         "api_key_required": bool(config.API_KEY),
         "webhook_configured": bool(config.WEBHOOK_URL)
@@ -563,13 +998,19 @@ async def health_check():
 
 @app.get("/", response_class=HTMLResponse)
 async def root():
-    """Главная страница с формой"""
-    try:
-        with open("index.html", "r", encoding="utf-8") as f:
-            return f.read()
-    except FileNotFoundError:
-        return HTMLResponse(content="<h1>index.html not found</h1>", status_code=404)
+    """Главная страница с формой (отдаётся из кэша в памяти)"""
+    return HTMLResponse(content=index_html, status_code=index_html_status)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop/httptools ускоряют каждый await на сокетах и subprocess
+    # (uvloop >= 0.15 — в более старых версиях сломан create_subprocess_exec)
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=os.cpu_count(),
+        log_config=UVICORN_LOG_CONFIG
+    )
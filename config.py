@@ -3,18 +3,39 @@ from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
     # Redis настройки
+    # Для удаления готовых файлов по TTL нужны уведомления об истёкших ключах:
+    # сервис включает notify-keyspace-events Ex сам, но если CONFIG SET
+    # запрещён (managed Redis), включите этот параметр на сервере вручную
     REDIS_URL: str = "redis://localhost:6379"
     REDIS_PASSWORD: str = ""
     REDIS_DB: int = 0
     REDIS_KEY_PREFIX: str = "video_task:"
+    REDIS_MAX_CONNECTIONS: int = 32
+    # Таймаут одной операции Redis (секунды): зависший Redis не должен
+    # копить висящие запросы
+    REDIS_TIMEOUT_SECONDS: float = 0.5
+    # Отдельный маленький пул для /health, чтобы проверки не занимали основной
+    REDIS_HEALTH_MAX_CONNECTIONS: int = 4
     
     # Пути
+    # TEMP_DIR и OUTPUT_DIR должны быть на одной файловой системе:
+    # тогда перемещение результата — это один rename, а не копирование
     TEMP_DIR: str = "./temp"
     OUTPUT_DIR: str = "./output"
     SCRIPT_PATH: str = "./process_all.sh"
     
     # Время хранения файлов (в часах)
     FILE_RETENTION_HOURS: int = 1
+
+    # Максимум одновременных обработок видео НА ОДИН ВОРКЕР-ПРОЦЕСС.
+    # Uvicorn запускает по воркеру на ядро, поэтому значение по умолчанию
+    # (0 = 1 слот) даёт суммарно по машине примерно число CPU обработок
+    MAX_CONCURRENT_ENCODES: int = 0
+
+    # Префикс internal-локации nginx для отдачи результатов через
+    # X-Accel-Redirect (например "/_protected"). Пустая строка — отдаём
+    # файл сами через FileResponse
+    NGINX_ACCEL_PREFIX: str = ""
     
     # API ключ для авторизации
     API_KEY: str = ""